@@ -1,15 +1,48 @@
 import time
+import queue
+import threading
+from math import ceil
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from ratelimit import limits, sleep_and_retry
+from ratelimit import FairShareLimiter
+from retry import RetryPolicy
+from tracing import tracer
 
 class OSAPIError(Exception):
+    # whether the same request may succeed later
+    transient = False
+
+class TransientError(OSAPIError):
+    # network errors and server errors
+    transient = True
+
+class CircuitOpenError(TransientError):
     pass
 
+class PaginationError(OSAPIError):
+    def __init__(self, message, resume, transient=False):
+        # arguments that make the paginator continue
+        # from the page that failed
+        super().__init__(message)
+        self.resume = resume
+        self.transient = transient
+
+def event_time(event):
+    return datetime.fromisoformat(
+        event["created_date"]
+    ).replace(tzinfo=timezone.utc).timestamp()
+
 """ API rate limit: 4/sec """
 
 
 class ApiClient:
     RATE = 4
+    # pages of events each time window is sized to hold
+    SHARD_PAGES = 4
+    EVENTS_PAGE_SIZE = 300
+    REQUEST_TIMEOUT = 30
     API_URL = "https://api.opensea.io/api/v1/"
     ASSETS_URL = API_URL + "assets/"
     ASSET_URL_TEMPLATE = API_URL + "asset/{}/{}/listings"
@@ -42,6 +75,18 @@ class ApiClient:
         "token_id",
         "collection",
     ]
+    listing_event_fields = [
+        "asset_url",
+        "image_url",
+        "contract_address",
+        "token_id",
+        "collection",
+        "seller",
+        "price",
+        "coin",
+        "price_usd",
+        "timestamp",
+    ]
     listing_fields = [
         "asset_url",
         "image_url",
@@ -80,32 +125,113 @@ class ApiClient:
         "floor_price",
     ]
 
-    def __init__(self, api_key):
+    def __init__(
+        self,
+        api_key,
+        limiter=None,
+        key=None,
+        retry_policy=None,
+        verbose=True,
+        log_file=None,
+    ):
         self.api_key = api_key
+        # clients created for different slugs can share one
+        # limiter, which splits the rate between them by key
+        if limiter == None:
+            limiter = FairShareLimiter(calls=self.RATE, period=1)
+        self.limiter = limiter
+        self.key = key
+        # sharing the retry policy also shares its circuit breakers
+        if retry_policy == None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        # log every successful request
+        self.verbose = verbose
+        # where messages are printed, stdout if None
+        self.log_file = log_file
         self.s = requests.Session()
         self.s.headers.update({"X-API-KEY": self.api_key})
-        self.timeout = 4
-        self.must_wait = False
-
-    @sleep_and_retry
-    @limits(calls=RATE, period=1)
-    def _get(self, *args, **kwargs):
-        while self.must_wait:
-            time.sleep(self.timeout)
-        r = self.s.get(*args, **kwargs)
-        while r.status_code == 429:
-            self.must_wait = True
-            print(f"429. Sleeping for {self.timeout} seconds")
-            self.timeout += 4
-            time.sleep(self.timeout)
-            r = self.s.get(*args, **kwargs)
-        self.must_wait = False
-        if r.status_code != 200:
-            raise OSAPIError(f"API returned {r.status_code} for {kwargs['url']}")
-        if self.timeout > 4:
-            self.timeout -= 4
+
+    def log(self, message):
+        print(message, file=self.log_file)
+
+    def endpoint(self, url):
+        for name, prefix in [
+            ("assets", self.ASSETS_URL),
+            ("listings", self.API_URL + "asset/"),
+            ("events", self.EVENTS_URL),
+            ("collection", self.COLLECTION_URL),
+        ]:
+            if url.startswith(prefix):
+                return name
+        return url
+
+    def _get(self, *args, label=None, page=None, **kwargs):
+        url = kwargs["url"]
+        endpoint = self.endpoint(url)
+        # details shown with the tracing spans of this request
+        span_args = {
+            "endpoint": endpoint,
+            "slug": self.key,
+            "label": label,
+            "page": page,
+        }
+        # the breaker counts requests, not attempts, so a
+        # single broken url can not open it for everyone
+        breaker = self.retry_policy.breaker(endpoint)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open, not requesting {url}")
+        try:
+            r = self._get_with_retries(args, kwargs, span_args)
+        except OSAPIError as e:
+            # a rejected request still means the endpoint works
+            if e.transient:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except BaseException:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
         return r
 
+    def _get_with_retries(self, args, kwargs, span_args):
+        url = kwargs["url"]
+        attempt = 0
+        while True:
+            with tracer.span("limiter", **span_args):
+                self.limiter.acquire(self.key)
+            try:
+                with tracer.span("network", **span_args):
+                    r = self.s.get(*args, timeout=self.REQUEST_TIMEOUT, **kwargs)
+                while r.status_code == 429:
+                    # the rate limit belongs to the api key, so
+                    # every client sharing the limiter waits
+                    pause = self.limiter.throttle()
+                    self.log(f"429. Pausing requests for {pause} seconds")
+                    with tracer.span("backoff", **span_args):
+                        self.limiter.acquire(self.key)
+                    with tracer.span("network", **span_args):
+                        r = self.s.get(*args, timeout=self.REQUEST_TIMEOUT, **kwargs)
+            except requests.RequestException as e:
+                error = f"{e.__class__.__name__} for {url}"
+            else:
+                if r.status_code == 200:
+                    self.limiter.relax()
+                    return r
+                error = f"API returned {r.status_code} for {url}"
+                # only server errors are worth retrying
+                if r.status_code < 500:
+                    raise OSAPIError(error)
+            if attempt >= self.retry_policy.retries:
+                raise TransientError(error)
+            backoff = self.retry_policy.backoff_time(attempt)
+            self.log(f"{error}. Retrying in {backoff:.1f} seconds")
+            with tracer.span("backoff", **span_args):
+                time.sleep(backoff)
+            attempt += 1
+
     def parse_listing(self, listing):
         res = {
             field: None for field in self.listing_fields
@@ -165,6 +291,34 @@ class ApiClient:
 
         return transaction
 
+    def parse_listing_event(self, event):
+        listing = {
+            field: None for field in self.listing_event_fields
+        }
+
+        if event["starting_price"] and event["payment_token"]:
+            decimals = int(event["payment_token"]["decimals"])
+            price = int(event["starting_price"])/(10**decimals)
+            listing["coin"] = event["payment_token"]["symbol"]
+            listing["price"] = price
+            if event["payment_token"]["usd_price"]:
+                usd_value = float(event["payment_token"]["usd_price"])
+                listing["price_usd"] = price*usd_value
+
+        if event["seller"]:
+            listing["seller"] = event["seller"]["address"]
+        listing["timestamp"] = event["created_date"]
+
+        if event["asset"]:
+            listing["asset_url"] = event["asset"]["permalink"]
+            listing["image_url"] = event["asset"]["image_url"]
+            listing["token_id"] = event["asset"]["token_id"]
+            listing["contract_address"] = event["asset"]["asset_contract"]["address"]
+            if event["asset"]["collection"]:
+                listing["collection"] = event["asset"]["collection"]["slug"]
+
+        return listing
+
     def parse_col_info(self, col_json):
         col_info = {
             field: None for field in self.col_fields
@@ -210,20 +364,65 @@ class ApiClient:
 
         return nft
 
+    def get_collection_json(self, slug):
+        r = self._get(url=self.COLLECTION_URL+slug, label=f"info for {slug}")
+        if self.verbose:
+            self.log(f"Got info for {slug}")
+        with tracer.span("decode", slug=self.key, label=f"info for {slug}"):
+            r_json = r.json()
+
+        return r_json["collection"]
+
     def get_collection_info(self, slug):
-        r = self._get(url=self.COLLECTION_URL+slug)
-        print(f"Got info for {slug}")
-        r_json = r.json()
-        col_json = r_json["collection"]
+        col_json = self.get_collection_json(slug)
 
         return self.parse_col_info(col_json)
 
-    def get_col_assets_data(self, slug, limit_requests=1):
-        params = {
-            "cursor": None,
-            "collection": slug,
-            "limit": 50,
-        }
+    def get_sales_windows(self, col_json, end=None):
+        """ Split the sales history of a collection into
+        (occurred_after, occurred_before) windows, newest
+        first, each expected to hold about SHARD_PAGES pages
+        of sales according to the collection stats. The
+        newest and oldest windows are left open. """
+        if end == None:
+            end = time.time()
+        created = datetime.fromisoformat(
+            col_json["created_date"]
+        ).replace(tzinfo=timezone.utc).timestamp()
+        col_info = self.parse_col_info(col_json)
+        one_day = col_info["one_day_sales"] or 0
+        seven_day = col_info["seven_day_sales"] or 0
+        thirty_day = col_info["thirty_day_sales"] or 0
+        total = col_info["total_sales"] or 0
+
+        day = 24*60*60
+        bands = [
+            (end - day, end, one_day),
+            (end - 7*day, end - day, seven_day - one_day),
+            (end - 30*day, end - 7*day, thirty_day - seven_day),
+            (created, end - 30*day, total - thirty_day),
+        ]
+        window_sales = self.EVENTS_PAGE_SIZE*self.SHARD_PAGES
+        windows = list()
+        for after, before, sales in bands:
+            after = max(after, created)
+            if before <= after:
+                continue
+            n_windows = max(1, ceil(max(sales, 0)/window_sales))
+            step = (before - after)/n_windows
+            for i in range(n_windows):
+                windows.append(
+                    (int(before - (i+1)*step), ceil(before - i*step))
+                )
+        if not windows:
+            return [(None, None)]
+        windows[0] = (windows[0][0], None)
+        windows[-1] = (None, windows[-1][1])
+
+        return windows
+
+    def _get_pages(self, url, params, label, limit_requests=1, cursor=None):
+        params["cursor"] = cursor
         req_n = 1
         first = True
         while (first or params["cursor"]) and (
@@ -231,129 +430,269 @@ class ApiClient:
         ):
             first = False
             try:
-                r = self._get(url=self.ASSETS_URL, params=params)
-                print(f"Got data for {slug} assets Request number {req_n}")
+                r = self._get(url=url, params=params, label=label, page=req_n)
+                if self.verbose:
+                    self.log(f"Got {label} Request number {req_n}")
             except OSAPIError as e:
-                print(e)
-                return list()
-            r_json = r.json()
+                # keep what is needed to continue from this page
+                if limit_requests != None:
+                    limit_requests -= req_n - 1
+                raise PaginationError(
+                    str(e),
+                    resume={
+                        "cursor": params["cursor"],
+                        "limit_requests": limit_requests,
+                    },
+                    transient=e.transient,
+                ) from e
+            with tracer.span("decode", slug=self.key, label=label, page=req_n):
+                r_json = r.json()
             params["cursor"] = r_json["next"]
             req_n += 1
-            yield [
-                {
-                    "asset_url": asset["permalink"],
-                    "image_url": asset["image_url"],
-                    "contract_address": asset["asset_contract"]["address"],
-                    "token_id": asset["token_id"],
-                    "owner": asset["owner"]["address"],
-                } for asset in r_json["assets"]
-            ]
+            yield req_n - 1, r_json
+
+    def get_col_assets_data(self, slug, limit_requests=1, cursor=None):
+        params = {
+            "collection": slug,
+            "limit": 50,
+        }
+        label = f"data for {slug} assets"
+        for req_n, r_json in self._get_pages(
+            self.ASSETS_URL, params, label,
+            limit_requests=limit_requests, cursor=cursor,
+        ):
+            with tracer.span("parse", slug=self.key, label=label, page=req_n):
+                page = [
+                    {
+                        "asset_url": asset["permalink"],
+                        "image_url": asset["image_url"],
+                        "contract_address": asset["asset_contract"]["address"],
+                        "token_id": asset["token_id"],
+                        "owner": asset["owner"]["address"],
+                    } for asset in r_json["assets"]
+                ]
+            yield page
 
-    def get_wallet_transactions(self, wallet, limit_requests=1):
+    def get_wallet_transactions(self, wallet, limit_requests=1, cursor=None):
         # skip default (null) wallet
         if wallet == "0x0000000000000000000000000000000000000000":
             return list()
         params = {
-            "cursor": None,
             "account_address": wallet,
             "event_type": "successful",
-            "limit": 300,
+            "limit": self.EVENTS_PAGE_SIZE,
         }
-        req_n = 1
-        first = True
-        while (first or params["cursor"]) and (
-            limit_requests == None or req_n <= limit_requests
+        label = f"transactions for {wallet}"
+        for req_n, r_json in self._get_pages(
+            self.EVENTS_URL, params, label,
+            limit_requests=limit_requests, cursor=cursor,
         ):
-            first = False
-            try:
-                r = self._get(url=self.EVENTS_URL, params=params)
-                print(f"Got transactions for {wallet} Request number {req_n}")
-            except OSAPIError as e:
-                print(e)
-                return list()
-            r_json = r.json()
-            params["cursor"] = r_json["next"]
-            req_n += 1
-            yield [
-                self.parse_transaction(event)
-                for event in r_json["asset_events"]
-            ]
+            with tracer.span("parse", slug=self.key, label=label, page=req_n):
+                page = [
+                    self.parse_transaction(event)
+                    for event in r_json["asset_events"]
+                ]
+            yield page
 
-    def get_collection_sales(self, slug, limit_requests=1):
+    def get_collection_sales(self, slug, limit_requests=1, cursor=None):
         params = {
-            "cursor": None,
             "collection_slug": slug,
             "event_type": "successful",
-            "limit": 300,
+            "limit": self.EVENTS_PAGE_SIZE,
         }
-        req_n = 1
-        first = True
-        while (first or params["cursor"]) and (
-            limit_requests == None or req_n <= limit_requests
+        label = f"sales for {slug}"
+        for req_n, r_json in self._get_pages(
+            self.EVENTS_URL, params, label,
+            limit_requests=limit_requests, cursor=cursor,
         ):
-            first = False
-            try:
-                r = self._get(url=self.EVENTS_URL, params=params)
-                print(f"Got sales for {slug} Request number {req_n}")
-            except OSAPIError as e:
-                print(e)
-                return list()
-            r_json = r.json()
-            params["cursor"] = r_json["next"]
-            req_n += 1
-            yield [
-                self.parse_transaction(event)
-                for event in r_json["asset_events"]
+            with tracer.span("parse", slug=self.key, label=label, page=req_n):
+                page = [
+                    self.parse_transaction(event)
+                    for event in r_json["asset_events"]
+                ]
+            yield page
+
+    def get_collection_events(
+        self, slug, event_type, occurred_after=None, limit_requests=None
+    ):
+        # unparsed events, newest first
+        params = {
+            "collection_slug": slug,
+            "event_type": event_type,
+            "occurred_after": occurred_after,
+            "limit": self.EVENTS_PAGE_SIZE,
+        }
+        for _, r_json in self._get_pages(
+            self.EVENTS_URL, params, f"{event_type} events for {slug}",
+            limit_requests=limit_requests,
+        ):
+            yield r_json["asset_events"]
+
+    def get_collection_sales_sharded(
+        self, slug, max_workers=None, windows=None, seen=()
+    ):
+        """ Get all the sales for a collection, paging
+        several time windows at once. Pages are yielded
+        newest first, without repeated events.
+
+        windows is a list of (occurred_after, occurred_before,
+        cursor) to page, by default the ones returned by
+        get_sales_windows, and seen the ids of the events
+        already yielded near their edges. Both are given by
+        the PaginationError raised when a window fails, to
+        continue from that window. """
+        if windows == None:
+            windows = [
+                (after, before, None) for after, before in
+                self.get_sales_windows(self.get_collection_json(slug))
             ]
+        params = {
+            "collection_slug": slug,
+            "event_type": "successful",
+            "limit": self.EVENTS_PAGE_SIZE,
+        }
+        yield from self._get_events_sharded(
+            params, windows, f"sales for {slug}", max_workers, seen
+        )
+
+    def _get_events_sharded(
+        self, params, windows, label, max_workers=None, seen=()
+    ):
+        if max_workers == None:
+            max_workers = 2*self.RATE
+        # bounded, so windows fetched ahead of the one
+        # being consumed wait instead of piling up in memory
+        pages = [queue.Queue(maxsize=self.SHARD_PAGES) for _ in windows]
+        stop = threading.Event()
+        # windows share their edges, so the ids of the
+        # events on an edge are kept to skip them in
+        # the next window
+        seen = set(seen)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # windows are submitted newest first,
+            # so they are also fetched in that order
+            for i, window in enumerate(windows):
+                executor.submit(
+                    self._get_events_window,
+                    dict(params), window, f"{label} window {i+1}",
+                    pages[i], stop,
+                )
+            try:
+                for i, window_pages in enumerate(pages):
+                    next_before = None
+                    if i + 1 < len(windows):
+                        next_before = windows[i + 1][1]
+                    for events in iter(window_pages.get, None):
+                        if isinstance(events, PaginationError):
+                            # continue from the failed window, so the
+                            # pages are still added newest first
+                            after, before, _ = windows[i]
+                            raise PaginationError(
+                                f"Window {i+1} of {len(windows)} failed "
+                                f"for {label}: {events}",
+                                resume={
+                                    "windows": [
+                                        (after, before, events.resume["cursor"])
+                                    ] + list(windows[i + 1:]),
+                                    "seen": sorted(seen),
+                                },
+                                transient=events.transient,
+                            ) from events
+                        with tracer.span("parse", slug=self.key, label=label):
+                            page = list()
+                            for event in events:
+                                if event["id"] in seen:
+                                    continue
+                                if (
+                                    next_before != None
+                                    and event_time(event) <= next_before
+                                ):
+                                    seen.add(event["id"])
+                                page.append(self.parse_transaction(event))
+                        yield page
+            finally:
+                stop.set()
 
-    def get_wallet_assets(self, wallet, limit_requests=1):
+    def _get_events_window(self, params, window, label, pages, stop):
+        after, before, cursor = window
+        params["occurred_after"] = after
+        params["occurred_before"] = before
+        params["cursor"] = cursor
+        # the consumer may be gone before this window started
+        if stop.is_set():
+            return
+        try:
+            for _, r_json in self._get_pages(
+                self.EVENTS_URL, params, label,
+                limit_requests=None, cursor=cursor,
+            ):
+                self._put_page(pages, r_json["asset_events"], stop)
+                if stop.is_set():
+                    return
+        except PaginationError as e:
+            self.log(e)
+            self._put_page(pages, e, stop)
+        except Exception as e:
+            # e.g. a truncated page, which would otherwise
+            # end the window as if it had no more sales
+            error = f"{e.__class__.__name__} for {label}: {e}"
+            self.log(error)
+            self._put_page(pages, PaginationError(
+                error,
+                resume={"cursor": params["cursor"], "limit_requests": None},
+            ), stop)
+        finally:
+            self._put_page(pages, None, stop)
+
+    def _put_page(self, pages, page, stop):
+        # wait for the consumer to make room, unless it stopped
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get_wallet_assets(self, wallet, limit_requests=1, cursor=None):
         # skip default (null) wallet
         if wallet == "0x0000000000000000000000000000000000000000":
             return list()
         params = {
-            "cursor": None,
             "owner": wallet,
             "limit": 50,
         }
-        req_n = 1
-        first = True
-        while (first or params["cursor"]) and (
-            limit_requests == None or req_n <= limit_requests
+        label = f"assets for {wallet}"
+        for req_n, r_json in self._get_pages(
+            self.ASSETS_URL, params, label,
+            limit_requests=limit_requests, cursor=cursor,
         ):
-            first = False
-            try:
-                r = self._get(url=self.ASSETS_URL, params=params)
-                print(f"Got assets for {wallet} Request number {req_n}")
-            except OSAPIError as e:
-                print(e)
-                return list()
-            r_json = r.json()
-            params["cursor"] = r_json["next"]
-            req_n += 1
-            yield [
-                self.parse_nft(asset)
-                for asset in r_json["assets"]
-            ]
+            with tracer.span("parse", slug=self.key, label=label, page=req_n):
+                page = [
+                    self.parse_nft(asset)
+                    for asset in r_json["assets"]
+                ]
+            yield page
 
     def get_asset_listings(self, contr_addr, token_id):
         params = {
             "limit": 50,
         }
-        try:
-            r = self._get(
-                url=self.ASSET_URL_TEMPLATE.format(contr_addr,token_id),
-                params=params
-            )
-            print(f"Got listings for {contr_addr} {token_id}")
-        except OSAPIError as e:
-            print(e)
-            return list()
-        r_json = r.json()
-        res = list()
-        for listing in r_json["listings"]:
-            lst = self.parse_listing(listing)
-            lst["contract_address"] = contr_addr
-            lst["token_id"] = token_id
-            res.append(lst)
+        label = f"listings for {contr_addr} {token_id}"
+        r = self._get(
+            url=self.ASSET_URL_TEMPLATE.format(contr_addr,token_id),
+            params=params,
+            label=label,
+        )
+        if self.verbose:
+            self.log(f"Got {label}")
+        with tracer.span("decode", slug=self.key, label=label):
+            r_json = r.json()
+        with tracer.span("parse", slug=self.key, label=label):
+            res = list()
+            for listing in r_json["listings"]:
+                lst = self.parse_listing(listing)
+                lst["contract_address"] = contr_addr
+                lst["token_id"] = token_id
+                res.append(lst)
 
         return res
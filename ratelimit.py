@@ -4,6 +4,7 @@ This module includes the decorator used to rate limit function invocations.
 Additionally this module includes a naive retry strategy to be used in
 conjunction with the rate limit decorator.
 '''
+from collections import deque, defaultdict
 from functools import wraps
 from math import floor
 
@@ -136,4 +137,111 @@ def sleep_and_retry(func):
                 time.sleep(exception.period_remaining)
     return wrapper
 
+class FairShareLimiter(object):
+    '''
+    Rate limiter shared between several callers, that hands out the
+    available calls round robin between the keys that are waiting.
+    '''
+    def __init__(self, calls=15, period=900, clock=now()):
+        '''
+        Instantiate a FairShareLimiter. Unlike RateLimitDecorator, the limit
+        is enforced over a sliding window, so calls are never bunched up at
+        the start of a period.
+        :param int calls: Maximum invocations allowed within a time period.
+        :param float period: The time period (in seconds) the limit applies to.
+        :param function clock: An optional function retuning the current time.
+        '''
+        self.clamped_calls = max(1, min(sys.maxsize, floor(calls)))
+        self.period = period
+        self.clock = clock
+
+        # Times of the calls granted within the last period.
+        self.grants = deque()
+        # Number of calls granted to every key so far.
+        self.granted = defaultdict(int)
+        # Pending tickets for every key, and the order in which
+        # the keys with pending tickets will be served.
+        self.waiting = dict()
+        self.rotation = deque()
+        # No calls are granted to any key before this time.
+        self.paused_until = clock()
+        self.penalty = 0
+
+        self.cond = threading.Condition()
+
+    def acquire(self, key=None):
+        '''
+        Block the current thread until a call can be made on behalf of key.
+        While several keys are waiting, each of them gets one call in turn,
+        so a key with many waiting threads can not starve the others.
+        :param key: The caller the call is made for (e.g. a collection slug).
+        '''
+        ticket = object()
+        with self.cond:
+            if key not in self.waiting:
+                self.waiting[key] = deque()
+                self.rotation.append(key)
+            self.waiting[key].append(ticket)
+
+            while True:
+                if self.waiting[self.rotation[0]][0] is ticket:
+                    period_remaining = self.__period_remaining()
+                    if period_remaining <= 0:
+                        break
+                    self.cond.wait(period_remaining)
+                else:
+                    self.cond.wait()
+
+            # Move this key to the back of the rotation.
+            self.waiting[key].popleft()
+            self.rotation.popleft()
+            if self.waiting[key]:
+                self.rotation.append(key)
+            else:
+                del self.waiting[key]
+
+            self.grants.append(self.clock())
+            self.granted[key] += 1
+            self.cond.notify_all()
+
+    def throttle(self, step=4):
+        '''
+        Pause the calls of every key, after the limit was exceeded anyway
+        (e.g. an API answering 429). The pause grows by step seconds each
+        time this happens before relax brings it back down.
+        :param float step: Seconds added to the pause.
+        :return: The length of the pause.
+        :rtype: float
+        '''
+        with self.cond:
+            self.penalty += step
+            self.paused_until = max(
+                self.paused_until, self.clock() + self.penalty
+            )
+            self.cond.notify_all()
+            return self.penalty
+
+    def relax(self, step=4):
+        '''
+        Shorten the next pause by step seconds, after a successful call.
+        :param float step: Seconds taken off the pause.
+        '''
+        with self.cond:
+            self.penalty = max(0, self.penalty - step)
+
+    def __period_remaining(self):
+        '''
+        Return the time until a new call fits within the limit.
+        :return: The remaining time, or 0 if a call can be made right away.
+        :rtype: float
+        '''
+        now = self.clock()
+        if self.paused_until > now:
+            return self.paused_until - now
+        while self.grants and now - self.grants[0] >= self.period:
+            self.grants.popleft()
+        if len(self.grants) < self.clamped_calls:
+            return 0
+        return self.grants[0] + self.period - now
+
 limits = RateLimitDecorator
@@ -0,0 +1,153 @@
+'''
+Retry policy for transient API errors.
+This module includes the exponential backoff with jitter used between
+retries, and the per endpoint circuit breakers that stop sending requests
+to an endpoint that keeps failing.
+'''
+import time
+import random
+import threading
+
+from ratelimit import now
+
+
+class CircuitBreaker(object):
+    '''
+    Circuit breaker for a single endpoint.
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=now()):
+        '''
+        Instantiate a CircuitBreaker. The circuit opens after
+        failure_threshold consecutive failed requests. Once reset_timeout
+        seconds have passed a single probe request is let through, while
+        the others wait for its outcome: a success closes the circuit, and
+        a failure opens it again.
+        :param int failure_threshold: Consecutive failures that open the circuit.
+        :param float reset_timeout: Seconds the circuit stays open.
+        :param function clock: An optional function retuning the current time.
+        '''
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+        self.cond = threading.Condition()
+
+    def allow(self):
+        '''
+        Return whether a request may be sent to the endpoint, waiting for
+        the probe request if there is one. A caller that is allowed must
+        report the outcome with record_success or record_failure.
+        :rtype: bool
+        '''
+        with self.cond:
+            while self.probing:
+                self.cond.wait()
+            if self.opened_at == None:
+                return True
+            if self.__remaining() > 0:
+                return False
+            self.probing = True
+            return True
+
+    def remaining(self):
+        '''
+        Return the time until the circuit lets a probe request through.
+        :return: The remaining time, or 0 if the circuit is not open.
+        :rtype: float
+        '''
+        with self.cond:
+            return self.__remaining()
+
+    def record_success(self):
+        with self.cond:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.cond.notify_all()
+
+    def record_failure(self):
+        with self.cond:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.probing = False
+            self.cond.notify_all()
+
+    def __remaining(self):
+        if self.opened_at == None:
+            return 0
+        return self.opened_at + self.reset_timeout - self.clock()
+
+
+class RetryPolicy(object):
+    '''
+    Retry policy shared by the clients of a run.
+    '''
+    def __init__(
+        self,
+        retries=4,
+        backoff=1,
+        max_backoff=30,
+        failure_threshold=5,
+        reset_timeout=30,
+        clock=now(),
+    ):
+        '''
+        Instantiate a RetryPolicy.
+        :param int retries: Retries for a request before giving up on it.
+        :param float backoff: Base delay (in seconds) of the exponential backoff.
+        :param float max_backoff: Upper bound for the delay between retries.
+        :param int failure_threshold: Consecutive failed requests that open a circuit.
+        :param float reset_timeout: Seconds a circuit stays open.
+        :param function clock: An optional function retuning the current time.
+        '''
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.breakers = dict()
+        self.lock = threading.Lock()
+
+    def backoff_time(self, attempt):
+        '''
+        Return the delay before retrying after the given failed attempt.
+        Uses full jitter, so clients that failed together do not retry
+        together.
+        :param int attempt: Number of the failed attempt, starting at 0.
+        :rtype: float
+        '''
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff*2**attempt)
+        )
+
+    def breaker(self, endpoint):
+        '''
+        Return the circuit breaker for an endpoint.
+        :param string endpoint: Name of the endpoint.
+        :rtype: CircuitBreaker
+        '''
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(
+                    failure_threshold=self.failure_threshold,
+                    reset_timeout=self.reset_timeout,
+                    clock=self.clock,
+                )
+            return self.breakers[endpoint]
+
+    def wait_for_breakers(self):
+        '''
+        Sleep until every open circuit lets requests through again.
+        '''
+        with self.lock:
+            breakers = list(self.breakers.values())
+        remaining = max([b.remaining() for b in breakers], default=0)
+        if remaining > 0:
+            time.sleep(remaining)
@@ -0,0 +1,257 @@
+import io
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import pytest
+
+from client import ApiClient, OSAPIError, PaginationError, TransientError
+
+DAY = 24*60*60
+
+
+def collection(created, one_day, seven_day, thirty_day, total):
+    stats = defaultdict(lambda: None)
+    stats.update(
+        one_day_sales=one_day,
+        seven_day_sales=seven_day,
+        thirty_day_sales=thirty_day,
+        total_sales=total,
+    )
+    return {
+        "created_date": time.strftime(
+            "%Y-%m-%dT%H:%M:%S", time.gmtime(created)
+        ),
+        "stats": stats,
+    }
+
+
+def event(id, t):
+    created_date = datetime.fromtimestamp(
+        t, timezone.utc
+    ).replace(tzinfo=None).isoformat()
+    return {
+        "id": id,
+        "created_date": created_date,
+        "total_price": None,
+        "payment_token": None,
+        "seller": None,
+        "transaction": {"timestamp": t, "from_account": None},
+        "asset": None,
+    }
+
+
+def windows_pages(events, page_size=2, delays=None, fail=None):
+    """ Return a stub for ApiClient._get_pages paging the
+    events (newest first) of every time window, sleeping
+    delays[before] before each page, and raising fail[before]
+    instead of its second page. """
+    delays = delays or dict()
+    fail = fail or dict()
+
+    def get_pages(url, params, label, limit_requests=1, cursor=None):
+        after = params["occurred_after"]
+        before = params["occurred_before"]
+        # edges are inclusive, like the API
+        window_events = [
+            e for e in events
+            if (after == None or e["transaction"]["timestamp"] >= after)
+            and (before == None or e["transaction"]["timestamp"] <= before)
+        ]
+        start = 0 if cursor == None else int(cursor)
+        for i in range(start, len(window_events), page_size):
+            time.sleep(delays.get(before, 0))
+            if i > 0 and cursor == None and before in fail:
+                params["cursor"] = str(i)
+                error = fail[before]
+                if isinstance(error, OSAPIError):
+                    # as _get_pages does
+                    raise PaginationError(
+                        str(error),
+                        resume={"cursor": str(i), "limit_requests": None},
+                        transient=error.transient,
+                    )
+                raise error
+            params["cursor"] = str(i + page_size)
+            yield i//page_size + 1, {
+                "asset_events": window_events[i:i + page_size]
+            }
+
+    return get_pages
+
+
+def test_sales_windows_cover_the_history():
+    client = ApiClient(api_key="")
+    window_sales = client.EVENTS_PAGE_SIZE*client.SHARD_PAGES
+    end = 1_600_000_000
+    created = end - 100*DAY
+    col_json = collection(
+        created,
+        one_day=2*window_sales,
+        seven_day=2*window_sales,
+        thirty_day=5*window_sales,
+        total=5*window_sales + 1,
+    )
+    windows = client.get_sales_windows(col_json, end=end)
+
+    # 2 windows for the last day, 1 for an empty band,
+    # 3 for the rest of the month and 1 before that
+    assert len(windows) == 7
+    # the newest and oldest windows are open
+    assert windows[0][1] == None
+    assert windows[-1][0] == None
+    # newest first, without gaps between windows
+    for newer, older in zip(windows, windows[1:]):
+        assert newer[0] <= older[1] <= newer[0] + 1
+    befores = [before for _, before in windows[1:]]
+    assert befores == sorted(befores, reverse=True)
+    for after, before in windows[1:]:
+        assert created <= before <= end
+    for after, before in windows[:-1]:
+        assert created <= after <= end
+
+
+def test_sales_windows_of_a_new_collection():
+    client = ApiClient(api_key="")
+    end = 1_600_000_000
+    col_json = collection(end - DAY//2, 0, 0, 0, 0)
+    assert client.get_sales_windows(col_json, end=end) == [(None, None)]
+
+
+# newest first, with events on the window edges
+EDGE_EVENTS = [event(i, t) for i, t in enumerate(
+    [130, 120, 101, 100, 90, 80, 51, 50, 40, 30, 20]
+)]
+EDGE_WINDOWS = [(100, None, None), (50, 101, None), (None, 51, None)]
+
+
+def sales_timestamps(pages):
+    return [sale["timestamp"] for page in pages for sale in page]
+
+
+def test_sharded_sales_are_deduplicated_and_ordered():
+    client = ApiClient(api_key="", verbose=False)
+    # the newest window is the slowest one
+    client._get_pages = windows_pages(EDGE_EVENTS, delays={None: 0.05})
+    pages = list(
+        client.get_collection_sales_sharded("slug", windows=EDGE_WINDOWS)
+    )
+    assert sales_timestamps(pages) == [
+        e["transaction"]["timestamp"] for e in EDGE_EVENTS
+    ]
+
+
+class Response:
+    def __init__(self, r_json):
+        self.r_json = r_json
+
+    def json(self):
+        return self.r_json
+
+
+def paged_client(n_pages, fail_at, error):
+    # page n is requested with cursor "c{n}",
+    # and the request for fail_at fails once
+    client = ApiClient(api_key="", verbose=False)
+    requested = list()
+
+    def get(url, params, label=None, page=None):
+        cursor = params["cursor"]
+        requested.append(cursor)
+        n = 1 if cursor == None else int(cursor[1:])
+        if n == fail_at and requested.count(cursor) == 1:
+            raise error
+        next_cursor = f"c{n + 1}" if n < n_pages else None
+        return Response({"next": next_cursor, "page": n})
+
+    client._get = get
+    return client, requested
+
+
+def test_pagination_resumes_from_the_failed_page():
+    client, requested = paged_client(
+        6, fail_at=3, error=TransientError("API returned 502")
+    )
+    pages = list()
+    with pytest.raises(PaginationError) as e:
+        for _, r_json in client._get_pages("url", dict(), "test", limit_requests=5):
+            pages.append(r_json["page"])
+    assert pages == [1, 2]
+    assert e.value.transient
+    assert e.value.resume == {"cursor": "c3", "limit_requests": 3}
+
+    for _, r_json in client._get_pages("url", dict(), "test", **e.value.resume):
+        pages.append(r_json["page"])
+    # the limit covers both runs
+    assert pages == [1, 2, 3, 4, 5]
+    assert requested == [None, "c2", "c3", "c3", "c4", "c5"]
+
+
+def test_pagination_without_limit_resumes_without_limit():
+    client, _ = paged_client(
+        4, fail_at=2, error=TransientError("API returned 502")
+    )
+    with pytest.raises(PaginationError) as e:
+        list(client._get_pages("url", dict(), "test", limit_requests=None))
+    assert e.value.resume == {"cursor": "c2", "limit_requests": None}
+    pages = [
+        r_json["page"] for _, r_json in
+        client._get_pages("url", dict(), "test", **e.value.resume)
+    ]
+    assert pages == [2, 3, 4]
+
+
+def test_client_errors_are_not_transient():
+    client, _ = paged_client(
+        4, fail_at=1, error=OSAPIError("API returned 404")
+    )
+    with pytest.raises(PaginationError) as e:
+        list(client._get_pages("url", dict(), "test", limit_requests=2))
+    assert not e.value.transient
+    assert e.value.resume == {"cursor": None, "limit_requests": 2}
+
+
+def test_failed_windows_resume_without_repeating_events():
+    client = ApiClient(api_key="", verbose=False, log_file=io.StringIO())
+    client._get_pages = windows_pages(
+        EDGE_EVENTS, fail={101: TransientError("API returned 502")}
+    )
+    pages = list()
+    with pytest.raises(PaginationError) as e:
+        for page in client.get_collection_sales_sharded(
+            "slug", windows=EDGE_WINDOWS
+        ):
+            pages.append(page)
+    assert e.value.transient
+    # the windows after the failed one are paged again,
+    # so the sales stay newest first
+    assert e.value.resume["windows"] == [(50, 101, "2"), (None, 51, None)]
+    # only the ids on window edges are kept
+    assert e.value.resume["seen"] == [2, 3]
+    assert sales_timestamps(pages) == [130, 120, 101, 100]
+
+    client._get_pages = windows_pages(EDGE_EVENTS)
+    for page in client.get_collection_sales_sharded(
+        "slug", **e.value.resume
+    ):
+        pages.append(page)
+    assert sales_timestamps(pages) == [
+        e["transaction"]["timestamp"] for e in EDGE_EVENTS
+    ]
+
+
+def test_broken_windows_are_reported():
+    client = ApiClient(api_key="", verbose=False, log_file=io.StringIO())
+    # e.g. a truncated page
+    client._get_pages = windows_pages(
+        EDGE_EVENTS, fail={51: ValueError("Expecting value")}
+    )
+    pages = list()
+    with pytest.raises(PaginationError) as e:
+        for page in client.get_collection_sales_sharded(
+            "slug", windows=EDGE_WINDOWS
+        ):
+            pages.append(page)
+    assert not e.value.transient
+    assert "ValueError" in str(e.value)
+    assert sales_timestamps(pages) == [130, 120, 101, 100, 90, 80, 51, 50]
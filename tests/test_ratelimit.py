@@ -0,0 +1,78 @@
+import time
+import threading
+
+from ratelimit import FairShareLimiter
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_sliding_window_rate():
+    calls, period = 3, 0.2
+    limiter = FairShareLimiter(calls=calls, period=period)
+    times = list()
+    for _ in range(3*calls):
+        limiter.acquire("a")
+        times.append(time.monotonic())
+    # the first calls are not held back
+    assert times[calls - 1] - times[0] < period/2
+    # and no period ever holds more than calls of them
+    for first, later in zip(times, times[calls:]):
+        assert later - first >= period*0.95
+
+
+def test_round_robin_between_keys():
+    limiter = FairShareLimiter(calls=1, period=0.05)
+    # keep the limiter busy while the callers line up
+    limiter.acquire("warmup")
+    order = list()
+    lock = threading.Lock()
+
+    def call(key):
+        limiter.acquire(key)
+        with lock:
+            order.append(key)
+
+    threads = list()
+    for _ in range(3):
+        threads.append(threading.Thread(target=call, args=("a",)))
+        threads[-1].start()
+    wait_until(lambda: len(limiter.waiting.get("a", ())) == 3)
+    threads.append(threading.Thread(target=call, args=("b",)))
+    threads[-1].start()
+    for t in threads:
+        t.join(timeout=2)
+
+    # b does not wait behind every call of a
+    assert order == ["a", "b", "a", "a"]
+    assert limiter.granted["a"] == 3
+    assert limiter.granted["b"] == 1
+
+
+def test_throttle_pauses_every_key():
+    now = [0.0]
+    limiter = FairShareLimiter(calls=10, period=1, clock=lambda: now[0])
+    assert limiter.throttle() == 4
+    assert limiter.throttle() == 8
+    limiter.relax()
+    assert limiter.throttle() == 8
+
+    granted = threading.Event()
+
+    def call():
+        limiter.acquire("b")
+        granted.set()
+
+    thread = threading.Thread(target=call)
+    thread.start()
+    # a key that never got a 429 waits too
+    assert not granted.wait(0.1)
+    now[0] = 8
+    with limiter.cond:
+        limiter.cond.notify_all()
+    assert granted.wait(2)
+    thread.join()
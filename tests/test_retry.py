@@ -0,0 +1,87 @@
+import io
+import threading
+
+import pytest
+
+from client import ApiClient, CircuitOpenError, TransientError
+from retry import CircuitBreaker, RetryPolicy
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_after_failed_requests():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    assert breaker.remaining() == 30
+    clock.now = 30
+    assert breaker.remaining() == 0
+
+
+def test_half_open_breaker_lets_a_single_probe_through():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    assert breaker.allow()
+    breaker.record_failure()
+    clock.now = 30
+    assert breaker.allow()
+
+    # the others wait for the probe
+    allowed = list()
+    thread = threading.Thread(target=lambda: allowed.append(breaker.allow()))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+
+    # which failed, so the circuit opens again
+    breaker.record_failure()
+    thread.join(2)
+    assert allowed == [False]
+    assert breaker.remaining() == 30
+
+    clock.now = 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.remaining() == 0
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_breaker_counts_requests_not_attempts(monkeypatch):
+    policy = RetryPolicy(retries=4, backoff=0, failure_threshold=2)
+    client = ApiClient(
+        api_key="", retry_policy=policy, log_file=io.StringIO()
+    )
+    attempts = list()
+
+    def get(*args, **kwargs):
+        attempts.append(kwargs["url"])
+        return Response(500)
+
+    monkeypatch.setattr(client.s, "get", get)
+    url = client.ASSET_URL_TEMPLATE.format("0x0", 1)
+    with pytest.raises(TransientError):
+        client._get(url=url)
+    # every retry of one broken url is a single failure
+    assert len(attempts) == 5
+    assert policy.breaker("listings").allow()
+
+    with pytest.raises(TransientError):
+        client._get(url=url)
+    with pytest.raises(CircuitOpenError):
+        client._get(url=url)
+    assert len(attempts) == 10
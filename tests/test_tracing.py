@@ -0,0 +1,89 @@
+import json
+import threading
+
+from tracing import Tracer, union_length
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def span(tracer, clock, thread_name, category, start, end, **args):
+    # every span is recorded from its own thread
+    def run():
+        clock.now = start
+        with tracer.span(category, **args):
+            clock.now = end
+
+    thread = threading.Thread(target=run, name=thread_name)
+    thread.start()
+    thread.join()
+
+
+def traced(clock):
+    tracer = Tracer(clock=clock)
+    tracer.enable()
+    span(tracer, clock, "a", "network", 0, 4, page=1)
+    span(tracer, clock, "b", "network", 2, 6, page=2)
+    span(tracer, clock, "a", "limiter", 6, 8)
+    span(tracer, clock, "b", "write", 1, 2)
+    return tracer
+
+
+def test_union_length():
+    assert union_length([]) == 0
+    assert union_length([(0, 2)]) == 2
+    # overlapping and nested intervals count once
+    assert union_length([(5, 6), (0, 2), (1, 3), (5.25, 5.5)]) == 4
+    assert union_length([(0, 1), (1, 2)]) == 2
+
+
+def test_disabled_tracer_records_nothing():
+    clock = Clock()
+    tracer = Tracer(clock=clock)
+    span(tracer, clock, "a", "network", 0, 4)
+    assert tracer.spans == []
+    assert tracer.summary() == "No spans recorded"
+
+
+def test_summary_shares():
+    clock = Clock()
+    lines = traced(clock).summary().splitlines()
+
+    assert lines[0] == "Wall time: 8.00s, thread time in spans: 11.00s"
+    rows = {
+        line.split(":")[0].strip(): line.split(":")[1].split()
+        for line in lines[2:]
+    }
+    # two threads on the network for 6 of the 8 seconds
+    assert rows["network"] == ["75.0%", "72.7%", "2"]
+    assert rows["limiter"] == ["25.0%", "18.2%", "1"]
+    assert rows["write"] == ["12.5%", "9.1%", "1"]
+    assert rows["parse"] == ["0.0%", "0.0%", "0"]
+
+
+def test_chrome_trace(tmp_path):
+    clock = Clock()
+    clock.now = 10
+    tracer = Tracer(clock=clock)
+    tracer.enable()
+    span(tracer, clock, "worker", "network", 11, 11.5, page=3)
+    path = tmp_path / "trace.json"
+    tracer.export_chrome_trace(str(path))
+
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    metadata, event = events
+    assert metadata["ph"] == "M"
+    assert metadata["args"] == {"name": "worker"}
+    assert event["tid"] == metadata["tid"]
+    assert event["ph"] == "X"
+    assert event["name"] == event["cat"] == "network"
+    # in microseconds since the tracer was enabled
+    assert event["ts"] == 1e6
+    assert event["dur"] == 0.5e6
+    assert event["args"] == {"page": "3"}
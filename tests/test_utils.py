@@ -0,0 +1,270 @@
+import os
+import builtins
+from collections import defaultdict
+from functools import partial
+
+import pandas as pd
+import pytest
+import requests
+
+import utils
+from client import ApiClient
+from retry import RetryPolicy
+from utils import (
+    READ_COLUMNS,
+    TABLES,
+    IncompleteDataError,
+    get_and_write_data,
+    get_data,
+    new_columns_tables,
+    run_slugs,
+)
+
+SLUG = "slug"
+N_NFTS = 4
+PAGE_SIZE = 2
+SELLERS = ["0xseller0", "0xseller1"]
+
+
+class Response:
+    def __init__(self, status_code, r_json=None):
+        self.status_code = status_code
+        self.r_json = r_json
+
+    def json(self):
+        return self.r_json
+
+
+def asset(token_id, owner=None):
+    return {
+        "permalink": f"https://opensea.io/assets/0xcontract/{token_id}",
+        "image_url": f"https://image/{token_id}",
+        "token_id": str(token_id),
+        "asset_contract": {"address": "0xcontract"},
+        "owner": {"address": owner},
+        "collection": {"slug": SLUG},
+    }
+
+
+def sale(seller):
+    return {
+        "id": seller,
+        "created_date": "2022-01-01T00:00:00",
+        "total_price": None,
+        "payment_token": None,
+        "seller": {"address": seller},
+        "transaction": {"timestamp": "2022-01-01T00:00:00", "from_account": None},
+        "asset": asset(0),
+    }
+
+
+class FakeApi:
+    """ Answers the requests of ApiClient for a collection
+    of N_NFTS nfts, paged PAGE_SIZE at a time, and the
+    wallets of their owners and sellers. The request for
+    a (endpoint, cursor or token id) in errors gets the
+    status codes listed there before being answered. """
+
+    def __init__(self, errors=None):
+        self.errors = defaultdict(list, errors or dict())
+        self.requested = defaultdict(int)
+
+    def get(self, url, params=None, timeout=None):
+        params = params or dict()
+        if url.startswith(ApiClient.COLLECTION_URL):
+            key = ("collection", None)
+        elif url.startswith(ApiClient.API_URL + "asset/"):
+            key = ("listings", url.split("/")[-2])
+        elif "collection" in params:
+            key = ("assets", params["cursor"])
+        elif "collection_slug" in params:
+            key = ("sales", params["cursor"])
+        elif "owner" in params:
+            key = ("wallet_nfts", params["owner"])
+        else:
+            key = ("wallet_transactions", params["account_address"])
+        self.requested[key] += 1
+        if self.errors[key]:
+            return Response(self.errors[key].pop(0))
+
+        endpoint, arg = key
+        if endpoint == "collection":
+            stats = defaultdict(lambda: None, total_sales=len(SELLERS))
+            return Response(200, {"collection": {
+                "created_date": "2021-01-01T00:00:00",
+                "stats": stats,
+            }})
+        if endpoint == "listings":
+            return Response(200, {"listings": [{
+                "base_price": "1000",
+                "payment_token_contract": None,
+                "created_date": "2022-01-01T00:00:00",
+                "closing_date": None,
+                "maker": {"address": f"0xowner{arg}"},
+                "taker": None,
+            }]})
+        if endpoint == "assets":
+            start = int(arg or 0)
+            end = min(start + PAGE_SIZE, N_NFTS)
+            return Response(200, {
+                "assets": [
+                    asset(i, owner=f"0xowner{i}") for i in range(start, end)
+                ],
+                "next": str(end) if end < N_NFTS else None,
+            })
+        if endpoint == "sales":
+            return Response(200, {
+                "asset_events": [sale(seller) for seller in SELLERS],
+                "next": None,
+            })
+        # every wallet holds one nft and made one sale
+        if endpoint == "wallet_nfts":
+            return Response(200, {"assets": [asset(arg)], "next": None})
+        return Response(200, {"asset_events": [sale(arg)], "next": None})
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = FakeApi()
+    monkeypatch.setattr(
+        requests.Session, "get", lambda self, **kwargs: api.get(**kwargs)
+    )
+    # no waiting for the rate limit, backoff or thread offsets
+    monkeypatch.setattr(ApiClient, "RATE", 100)
+    monkeypatch.setattr(utils, "THREAD_OFFSET", 0)
+    monkeypatch.setattr(utils, "RetryPolicy", partial(RetryPolicy, backoff=0))
+    return api
+
+
+def run(new_tables=new_columns_tables, **limits):
+    limits = dict(dict(
+        get_collection_nfts_request_limit=None,
+        get_listings_request_limit=None,
+        get_wallet_transactions_request_limit=1,
+        get_wallet_nfts_request_limit=1,
+        get_collection_sales_request_limit=1,
+    ), **limits)
+    results, failed = run_slugs(
+        new_tables, api_key="", slugs=[SLUG], max_concurrent_slugs=1, **limits
+    )
+    return results.get(SLUG), failed
+
+
+def n_rows(tables, name):
+    table = tables[name]
+    return len(next(iter(table.columns.values())))
+
+
+def test_recovered_nfts_get_their_listings_and_wallets(api):
+    # the second page of nfts fails every retry
+    api.errors[("assets", "2")] = [500]*5
+    tables, failed = run()
+
+    assert api.requested[("assets", "2")] == 6
+    assert failed == dict()
+    assert n_rows(tables, "nfts") == N_NFTS
+    assert n_rows(tables, "listings") == N_NFTS
+    assert n_rows(tables, "owner_transactions") == N_NFTS
+    assert n_rows(tables, "owner_and_seller_nfts") == N_NFTS + len(SELLERS)
+
+
+def test_recovered_sales_get_their_sellers_wallets(api):
+    api.errors[("sales", None)] = [502]*5
+    tables, failed = run()
+
+    assert failed == dict()
+    assert n_rows(tables, "sales") == len(SELLERS)
+    assert n_rows(tables, "owner_and_seller_nfts") == N_NFTS + len(SELLERS)
+    # every wallet is requested once
+    assert all(
+        n == 1 for (endpoint, _), n in api.requested.items()
+        if endpoint.startswith("wallet")
+    )
+
+
+def test_collection_info_is_retried(api):
+    api.errors[("collection", None)] = [503]*5
+    tables, failed = run(get_collection_sales_request_limit=None)
+
+    assert failed == dict()
+    assert n_rows(tables, "info") == 1
+    assert n_rows(tables, "sales") == len(SELLERS)
+
+
+def test_rejected_work_is_reported(api):
+    api.errors[("listings", "1")] = [404]
+    tables, failed = run()
+
+    assert api.requested[("listings", "1")] == 1
+    assert isinstance(failed[SLUG], IncompleteDataError)
+    assert len(failed[SLUG].entries) == 1
+    assert n_rows(tables, "listings") == N_NFTS - 1
+
+
+def test_work_failing_every_round_is_reported(api):
+    api.errors[("wallet_nfts", "0xseller0")] = [500]*100
+    tables, failed = run()
+
+    assert isinstance(failed[SLUG], IncompleteDataError)
+    (func, kwargs), = failed[SLUG].entries
+    assert kwargs["wallet"] == "0xseller0"
+    assert n_rows(tables, "owner_and_seller_nfts") == N_NFTS + len(SELLERS) - 1
+
+
+def comparable(df):
+    # rows of threaded work come in any order
+    df = df.fillna("").astype(str)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_frames_and_csvs_hold_the_same_data(api, tmp_path, monkeypatch):
+    limits = dict(
+        get_collection_nfts_request_limit=None,
+        get_listings_request_limit=None,
+        get_collection_sales_request_limit=1,
+    )
+    data, failed = get_data(
+        "", [SLUG], output_dir=str(tmp_path / "frames"), **limits
+    )
+    assert failed == dict()
+
+    # the csv tables are never read back while the data is extracted
+    csv_dir = str(tmp_path / "csv")
+    real_open = builtins.open
+
+    def open_for_writing(path, mode='r', *args, **kwargs):
+        assert not (str(path).startswith(csv_dir) and 'r' in mode)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", open_for_writing)
+    api.requested.clear()
+    failed = get_and_write_data("", [SLUG], output_dir=csv_dir, **limits)
+    monkeypatch.setattr(builtins, "open", real_open)
+    assert failed == dict()
+
+    # owners and sellers are all found from the kept columns
+    wallets = {
+        arg for endpoint, arg in api.requested if endpoint == "wallet_nfts"
+    }
+    assert wallets == {f"0xowner{i}" for i in range(N_NFTS)} | set(SELLERS)
+
+    for name, file_name, fields in TABLES:
+        frame = data[SLUG][name]
+        assert list(frame.columns) == fields
+        assert len(frame) > 0
+        for directory in [csv_dir, str(tmp_path / "frames")]:
+            written = pd.read_csv(
+                os.path.join(directory, SLUG, file_name),
+                dtype=str, keep_default_na=False,
+            )
+            assert list(written.columns) == fields
+            pd.testing.assert_frame_equal(comparable(written), comparable(frame))
+
+
+def test_csv_tables_only_keep_the_columns_read_back(api, tmp_path):
+    tables, failed = run(partial(utils.new_csv_tables, output_dir=str(tmp_path)))
+    assert failed == dict()
+    for name, _, _ in TABLES:
+        assert list(tables[name].kept) == list(READ_COLUMNS.get(name, ()))
+    assert len(tables["nfts"].column("owner")) == N_NFTS
+    assert sorted(tables["sales"].column("seller")) == SELLERS
@@ -0,0 +1,142 @@
+import io
+from datetime import datetime, timezone
+
+from client import OSAPIError
+from watch import LAG, SlugWatch, load_state, save_state
+
+T0 = 1_600_000_000
+
+
+def event(id, t):
+    created_date = datetime.fromtimestamp(
+        T0 + t, timezone.utc
+    ).replace(tzinfo=None).isoformat()
+    return {"id": id, "created_date": created_date}
+
+
+class Client:
+    """ Returns the given lists of events, newest
+    first, one list per poll, or raises them. """
+
+    def __init__(self, polls):
+        self.polls = list(polls)
+        self.requested = list()
+        self.log_file = io.StringIO()
+
+    def get_collection_events(self, slug, event_type, occurred_after=None):
+        self.requested.append(occurred_after)
+        events = self.polls.pop(0)
+        if isinstance(events, Exception):
+            raise events
+        yield events
+
+    def parse_transaction(self, event):
+        return {"created_date": event["created_date"]}
+
+    parse_listing_event = parse_transaction
+
+    def log(self, message):
+        print(message, file=self.log_file)
+
+
+class Sink:
+    def __init__(self):
+        self.events = list()
+
+    def emit(self, slug, event_type, events):
+        self.events.append([event["id"] for event in events])
+
+
+def test_marks_and_seen_events_across_polls():
+    e1, e2, e3, e4 = event(1, 10), event(2, 20), event(3, 100), event(4, 90)
+    client = Client([
+        [e2, e1],
+        [e3, e2, e1],
+        # e4 shows up late, behind the mark
+        [e3, e4],
+        [e3, e4],
+        OSAPIError("API returned 502"),
+        [e3, e4],
+    ])
+    sink = Sink()
+    w = SlugWatch(
+        "slug", client, event_types=["successful"],
+        state={"successful": {"after": T0, "seen": []}},
+    )
+
+    def mark():
+        return w.marks["successful"]
+
+    assert w.poll(sink) == 2
+    assert sink.events[-1] == [1, 2]
+    assert mark()["after"] == T0 + 20
+    assert mark()["seen"] == {1, 2}
+
+    assert w.poll(sink) == 1
+    assert sink.events[-1] == [3]
+    assert mark()["after"] == T0 + 100
+    # older events can not be returned again
+    assert mark()["seen"] == {3}
+
+    assert w.poll(sink) == 1
+    assert sink.events[-1] == [4]
+    assert mark()["after"] == T0 + 100
+    assert mark()["seen"] == {3, 4}
+
+    # every poll looks LAG seconds behind the mark
+    assert client.requested == [T0 - LAG, T0 + 20 - LAG, T0 + 100 - LAG]
+
+    # nothing new, so the collection is polled less often
+    assert w.poll(sink) == 0
+    interval = w.interval
+    assert interval > w.min_interval
+
+    # a failed poll keeps the mark and the interval
+    assert w.poll(sink) == 0
+    assert mark()["after"] == T0 + 100
+    assert mark()["seen"] == {3, 4}
+    assert w.interval == interval
+    assert "502" in client.log_file.getvalue()
+
+    # and a restarted watch emits nothing twice
+    restarted = SlugWatch(
+        "slug", client, event_types=["successful"], state=w.state(),
+    )
+    assert restarted.poll(sink) == 0
+    assert client.requested[-1] == T0 + 100 - LAG
+
+
+def test_interval_follows_activity():
+    client = Client([[], [], [event(1, 10)]])
+    w = SlugWatch(
+        "slug", client, event_types=["successful"],
+        min_interval=2, max_interval=4,
+        state={"successful": {"after": T0, "seen": []}},
+    )
+    w.poll(Sink())
+    assert w.interval == 3
+    w.poll(Sink())
+    assert w.interval == 4
+    w.poll(Sink())
+    assert w.interval == 2
+
+
+def test_saved_state_is_loaded_back(tmp_path):
+    client = Client([[event(2, 20), event(1, 10)]])
+    w = SlugWatch(
+        "slug", client, event_types=["successful"],
+        state={"successful": {"after": T0, "seen": []}},
+    )
+    w.poll(Sink())
+    state_path = str(tmp_path / "state.json")
+    save_state(state_path, {w.slug: w.state()})
+
+    state = load_state(state_path)
+    assert state == {
+        "slug": {"successful": {"after": T0 + 20, "seen": [1, 2]}}
+    }
+    restarted = SlugWatch(
+        "slug", client, event_types=["successful"], state=state["slug"],
+    )
+    assert restarted.marks == w.marks
+    assert load_state(str(tmp_path / "missing.json")) == dict()
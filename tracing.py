@@ -0,0 +1,167 @@
+'''
+Request level tracing.
+This module includes the tracer used to time the phases of a crawl (limiter
+waits, backoff sleeps, network, decoding, parsing and writing), export them
+as a Chrome trace / Perfetto timeline, and summarize where the time went.
+Tracing is disabled by default, and costs a single check per span until
+enabled.
+'''
+from contextlib import contextmanager, nullcontext
+
+import json
+import time
+import threading
+
+CATEGORIES = [
+    "limiter",
+    "backoff",
+    "network",
+    "decode",
+    "parse",
+    "write",
+]
+
+_disabled_span = nullcontext()
+
+
+class Tracer(object):
+    '''
+    Tracer class.
+    '''
+    def __init__(self, clock=time.perf_counter):
+        '''
+        Instantiate a disabled Tracer.
+        :param function clock: An optional function retuning the current time.
+        '''
+        self.clock = clock
+        self.enabled = False
+        self.start = clock()
+        self.spans = list()
+        self.threads = dict()
+        self.lock = threading.Lock()
+
+    def enable(self):
+        '''
+        Start recording spans, dropping the ones recorded before.
+        '''
+        with self.lock:
+            self.start = self.clock()
+            self.spans = list()
+            self.threads = dict()
+        self.enabled = True
+
+    def disable(self):
+        '''
+        Stop recording spans. The recorded ones are kept.
+        '''
+        self.enabled = False
+
+    def span(self, category, **args):
+        '''
+        Return a context manager that records the time spent within it.
+        :param string category: One of CATEGORIES.
+        :param args: Details shown with the span (endpoint, slug, page...).
+        :return: Context manager.
+        '''
+        if not self.enabled:
+            return _disabled_span
+        return self._span(category, args)
+
+    @contextmanager
+    def _span(self, category, args):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            end = self.clock()
+            thread = threading.current_thread()
+            with self.lock:
+                self.threads[thread.ident] = thread.name
+                self.spans.append(
+                    (category, start, end, thread.ident, args)
+                )
+
+    def export_chrome_trace(self, path):
+        '''
+        Write the recorded spans to a Chrome trace JSON file, which can be
+        opened in chrome://tracing or ui.perfetto.dev.
+        :param string path: Path of the file to write.
+        '''
+        with self.lock:
+            spans = list(self.spans)
+            threads = dict(self.threads)
+        events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 0,
+                "tid": tid,
+                "args": {"name": name},
+            } for tid, name in threads.items()
+        ]
+        for category, start, end, tid, args in spans:
+            events.append({
+                "name": category,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.start)*1e6,
+                "dur": (end - start)*1e6,
+                "pid": 0,
+                "tid": tid,
+                "args": {k: str(v) for k, v in args.items()},
+            })
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events}, f)
+
+    def summary(self):
+        '''
+        Return a report of the time spent in every category. "wall" is the
+        share of the wall time covered by the trace during which at least
+        one thread was in that category, and "threads" is the category's
+        share of the time all threads spent within spans.
+        :rtype: string
+        '''
+        with self.lock:
+            spans = list(self.spans)
+        if not spans:
+            return "No spans recorded"
+        wall = max(s[2] for s in spans) - min(s[1] for s in spans)
+        intervals = {category: list() for category in CATEGORIES}
+        for category, start, end, _, _ in spans:
+            intervals.setdefault(category, list()).append((start, end))
+        thread_total = sum(end - start for _, start, end, _, _ in spans)
+
+        lines = [
+            f"Wall time: {wall:.2f}s, "
+            f"thread time in spans: {thread_total:.2f}s",
+            f"{'':>8}  {'wall':>6}  {'threads':>7}  spans",
+        ]
+        for category, category_intervals in intervals.items():
+            busy = union_length(category_intervals)
+            seconds = sum(end - start for start, end in category_intervals)
+            wall_share = 100*busy/wall if wall > 0 else 0
+            thread_share = 100*seconds/thread_total if thread_total > 0 else 0
+            lines.append(
+                f"{category:>8}: {wall_share:5.1f}%  {thread_share:6.1f}%  "
+                f"{len(category_intervals)}"
+            )
+        return "\n".join(lines)
+
+def union_length(intervals):
+    '''
+    Return the total length covered by a list of (start, end) intervals,
+    counting overlapping parts once.
+    :rtype: float
+    '''
+    length = 0
+    covered_until = None
+    for start, end in sorted(intervals):
+        if covered_until == None or start > covered_until:
+            length += end - start
+            covered_until = end
+        elif end > covered_until:
+            length += end - covered_until
+            covered_until = end
+    return length
+
+tracer = Tracer()
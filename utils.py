@@ -1,45 +1,233 @@
 import os
 import csv
 import time
-from threading import RLock
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import RLock, Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from client import ApiClient
+import pandas as pd
+
+from client import ApiClient, OSAPIError
+from ratelimit import FairShareLimiter
+from retry import RetryPolicy
+from tracing import tracer
 
 THREAD_OFFSET = 0.5
+MAX_CONCURRENT_SLUGS = 8
+# rounds of retries for the work that failed during a run
+FAILED_WORK_ROUNDS = 2
 rlock = RLock()
 
+class IncompleteDataError(Exception):
+    """ Raised for a slug whose data is missing work the
+    API rejected, or that kept failing after every retry
+    round. """
+
+    def __init__(self, entries):
+        super().__init__(f"{len(entries)} requests could not be completed")
+        self.entries = entries
+
+class FailedWork:
+    """ Ledger of the work that failed during a run,
+    so it can be retried once the run is over. """
+
+    def __init__(self):
+        self.entries = list()
+        # work that would fail again, which is only reported
+        self.dropped = list()
+        # called after every round, to schedule the work
+        # that depends on the data the round recovered
+        self.follow_ups = list()
+        self.lock = Lock()
+
+    def record(self, func, kwargs, error):
+        # paginators that fail tell where to continue from,
+        # so the pages that were already saved are not fetched again
+        kwargs = dict(kwargs, **getattr(error, "resume", dict()))
+        with self.lock:
+            self.entries.append((func, kwargs))
+
+    def drop(self, func, kwargs):
+        with self.lock:
+            self.dropped.append((func, kwargs))
+
+    def follow_up(self, func):
+        with self.lock:
+            self.follow_ups.append(func)
+
+    def retry(self, retry_policy, rounds=FAILED_WORK_ROUNDS):
+        for round_n in range(rounds):
+            with self.lock:
+                entries = self.entries
+                self.entries = list()
+            if not entries:
+                break
+            print(f"Retrying {len(entries)} failed requests, round {round_n+1}")
+            with ThreadPoolExecutor(max_workers=ApiClient.RATE) as executor:
+                for func, kwargs in entries:
+                    executor.submit(
+                        self.retry_work, retry_policy, func, kwargs
+                    )
+            for follow_up in self.follow_ups:
+                follow_up()
+        if self.entries:
+            print(f"Gave up on {len(self.entries)} failed requests")
+        return self.entries
+
+    def retry_work(self, retry_policy, func, kwargs):
+        # a circuit can open again while the round runs, so
+        # every entry waits instead of failing right away
+        retry_policy.wait_for_breakers()
+        run_work(self, func, **kwargs)
+
+def run_work(ledger, func, **kwargs):
+    try:
+        return func(**kwargs)
+    except OSAPIError as e:
+        print(e)
+        # requests the API rejected would fail again
+        if e.transient:
+            ledger.record(func, kwargs, e)
+        else:
+            ledger.drop(func, kwargs)
+    except Exception as e:
+        print(e)
+        ledger.drop(func, kwargs)
+
 def write_things_to_file(things, path, fieldnames):
-    with rlock:
+    # the span includes the wait for the lock, like
+    # the one of ColumnsTable.add
+    with tracer.span("write", path=path, rows=len(things)), rlock:
         with open(path, 'a') as f:
             thing_writer = csv.DictWriter(f, fieldnames=fieldnames)
             thing_writer.writerows(things)
 
-def save_wallet_assets(wallet, api_client, file_path, limit_requests=1):
-    try:
-        for assets_list in api_client.get_wallet_assets(
-            wallet, limit_requests=limit_requests
-        ):
-            write_things_to_file(
-                things=assets_list,
-                path=file_path,
-                fieldnames=api_client.nft_fields,
-            )
-    except Exception as e:
-        print(e)
+def extend_columns(columns, things):
+    with rlock:
+        for thing in things:
+            for field, column in columns.items():
+                column.append(thing[field])
 
-def save_wallet_transactions(wallet, api_client, file_path, limit_requests=1):
-    try:
-        for wal_hist_list in api_client.get_wallet_transactions(
-            wallet, limit_requests=limit_requests
-        ):
-            write_things_to_file(
-                things=wal_hist_list,
-                path=file_path,
-                fieldnames=api_client.transaction_fields,
-            )
-    except Exception as e:
-        print(e)
+class ColumnsTable:
+    """ Keeps the rows added to it in memory,
+    as a list of values for every field. """
+
+    def __init__(self, fieldnames):
+        self.columns = {field: list() for field in fieldnames}
+
+    def add(self, things):
+        with tracer.span("write", rows=len(things)):
+            extend_columns(self.columns, things)
+
+    def column(self, field):
+        return self.columns[field]
+
+class CsvTable:
+    """ Appends the rows added to it to the csv file
+    at path, keeping in memory only the fields in keep,
+    which are read back while the data is extracted. """
+
+    def __init__(self, path, fieldnames, keep=()):
+        self.path = path
+        self.fieldnames = fieldnames
+        self.kept = {field: list() for field in keep}
+        with open(path, 'a') as f:
+            thing_writer = csv.DictWriter(f, fieldnames=fieldnames)
+            thing_writer.writeheader()
+
+    def add(self, things):
+        write_things_to_file(
+            things=things,
+            path=self.path,
+            fieldnames=self.fieldnames,
+        )
+        extend_columns(self.kept, things)
+
+    def column(self, field):
+        return self.kept[field]
+
+# name, csv file and fields of every table
+TABLES = [
+    ("info", 'info.csv', ApiClient.col_fields),
+    ("nfts", 'nft_data.csv', ApiClient.data_fields),
+    ("listings", 'listings.csv', ApiClient.listing_fields),
+    ("sales", 'collection_sales.csv', ApiClient.transaction_fields),
+    ("owner_transactions", 'owner_transactions.csv', ApiClient.transaction_fields),
+    ("owner_and_seller_nfts", 'owner_and_seller_nfts.csv', ApiClient.nft_fields),
+]
+# the columns get_slug_data reads back from its tables
+READ_COLUMNS = {
+    "nfts": ApiClient.data_fields,
+    "sales": ["seller"],
+}
+
+def new_columns_tables(slug):
+    return {
+        name: ColumnsTable(fields) for name, _, fields in TABLES
+    }
+
+def new_csv_tables(slug, output_dir):
+    os.makedirs(os.path.join(output_dir, slug), exist_ok=True)
+    return {
+        name: CsvTable(
+            os.path.join(output_dir, slug, file_name),
+            fields,
+            keep=READ_COLUMNS.get(name, ()),
+        ) for name, file_name, fields in TABLES
+    }
+
+def get_collection_sales(
+    slug, api_client, limit_requests=1, cursor=None, windows=None, seen=()
+):
+    # the whole history can be paged in parallel time windows,
+    # but a limited number of requests has to follow the
+    # cursor from the newest sale
+    if limit_requests == None:
+        return api_client.get_collection_sales_sharded(
+            slug, windows=windows, seen=seen
+        )
+    return api_client.get_collection_sales(
+        slug, limit_requests=limit_requests, cursor=cursor
+    )
+
+def save_col_info(slug, api_client, table):
+    col_json = api_client.get_collection_json(slug)
+    table.add([api_client.parse_col_info(col_json)])
+    return col_json
+
+def save_col_assets_data(slug, api_client, table, limit_requests=1, cursor=None):
+    for data_list in api_client.get_col_assets_data(
+        slug, limit_requests=limit_requests, cursor=cursor
+    ):
+        table.add(data_list)
+
+def save_collection_sales(
+    slug,
+    api_client,
+    table,
+    limit_requests=1,
+    cursor=None,
+    windows=None,
+    seen=(),
+):
+    for sales_list in get_collection_sales(
+        slug, api_client,
+        limit_requests=limit_requests, cursor=cursor,
+        windows=windows, seen=seen,
+    ):
+        table.add(sales_list)
+
+def save_wallet_assets(wallet, api_client, table, limit_requests=1, cursor=None):
+    for assets_list in api_client.get_wallet_assets(
+        wallet, limit_requests=limit_requests, cursor=cursor
+    ):
+        table.add(assets_list)
+
+def save_wallet_transactions(wallet, api_client, table, limit_requests=1, cursor=None):
+    for wal_hist_list in api_client.get_wallet_transactions(
+        wallet, limit_requests=limit_requests, cursor=cursor
+    ):
+        table.add(wal_hist_list)
 
 def save_asset_listings(
     contr_addr,
@@ -47,22 +235,315 @@ def save_asset_listings(
     asset_url,
     image_url,
     api_client,
-    file_path,
+    table,
 ):
-    try:
-        listings = api_client.get_asset_listings(
-            contr_addr, token_id
+    listings = api_client.get_asset_listings(
+        contr_addr, token_id
+    )
+    for listing in listings:
+        listing["asset_url"] = asset_url
+        listing["image_url"] = image_url
+    table.add(listings)
+
+def print_progress(slug, api_client, message):
+    requests_made = api_client.limiter.granted[slug]
+    print(f"[{slug}] {message} ({requests_made} requests so far)")
+
+def run_slugs(
+    new_tables, api_key, slugs, max_concurrent_slugs, trace_path=None, **kwargs
+):
+    # every slug gets its own client, so a failing slug
+    # can not affect the others, but they all share the
+    # same limiter, which takes turns between the slugs,
+    # and the same circuit breakers
+    limiter = FairShareLimiter(calls=ApiClient.RATE, period=1)
+    retry_policy = RetryPolicy()
+    ledger = FailedWork()
+    if trace_path != None:
+        tracer.enable()
+    results = dict()
+    failed = dict()
+    with ThreadPoolExecutor(max_workers=max_concurrent_slugs) as executor:
+        futures = {
+            executor.submit(
+                get_slug_data,
+                slug=slug,
+                api_client=ApiClient(
+                    api_key=api_key,
+                    limiter=limiter,
+                    key=slug,
+                    retry_policy=retry_policy,
+                ),
+                ledger=ledger,
+                tables=new_tables(slug),
+                **kwargs,
+            ): slug for slug in slugs
+        }
+        for future in as_completed(futures):
+            slug = futures[future]
+            try:
+                results[slug] = future.result()
+                print(f"[{slug}] Done ({limiter.granted[slug]} requests)")
+            except Exception as e:
+                failed[slug] = e
+                print(f"[{slug}] Failed: {e}")
+    # slugs whose data is missing work that was rejected or
+    # kept failing are returned, but also reported as failed
+    unfinished = dict()
+    for func, work_kwargs in ledger.retry(retry_policy) + ledger.dropped:
+        unfinished.setdefault(work_kwargs["api_client"].key, list()).append(
+            (func, work_kwargs)
         )
-        for listing in listings:
-            listing["asset_url"] = asset_url
-            listing["image_url"] = image_url
-        write_things_to_file(
-            things=listings,
-            path=file_path,
-            fieldnames=api_client.listing_fields,
+    for slug, entries in unfinished.items():
+        failed.setdefault(slug, IncompleteDataError(entries))
+        print(f"[{slug}] Incomplete: {failed[slug]}")
+    print(f"Processed {len(results)} of {len(slugs)} slugs")
+    if trace_path != None:
+        tracer.disable()
+        tracer.export_chrome_trace(trace_path)
+        print(tracer.summary())
+    return results, failed
+
+def get_data(
+    api_key,
+    slugs,
+    get_collection_nfts_request_limit=1,
+    get_listings_request_limit=1,
+    get_wallet_transactions_request_limit=1,
+    get_wallet_nfts_request_limit=1,
+    get_collection_sales_request_limit=1,
+    output_dir=None,
+    max_concurrent_slugs=MAX_CONCURRENT_SLUGS,
+    trace_path=None,
+):
+    """ This function performs the same data extraction
+    as get_and_write_data, but keeps the results in memory
+    and returns them as pandas DataFrames.
+
+    Returns a dict mapping every slug to a dict with the
+    following DataFrames: "info", "nfts", "listings",
+    "sales", "owner_transactions" and
+    "owner_and_seller_nfts", and a dict with the
+    exception for every slug that failed, as returned
+    by get_and_write_data.
+
+    The request limits, max_concurrent_slugs and
+    trace_path work as in get_and_write_data. Slugs
+    that could not be processed are left out of the
+    DataFrames, while slugs with an IncompleteDataError
+    keep the data that was fetched.
+    If output_dir is given, every DataFrame is also
+    written to a csv file within it, using the same
+    layout as get_and_write_data. """
+
+    tables, failed = run_slugs(
+        new_columns_tables,
+        api_key=api_key,
+        slugs=slugs,
+        max_concurrent_slugs=max_concurrent_slugs,
+        trace_path=trace_path,
+        get_collection_nfts_request_limit=get_collection_nfts_request_limit,
+        get_listings_request_limit=get_listings_request_limit,
+        get_wallet_transactions_request_limit=get_wallet_transactions_request_limit,
+        get_wallet_nfts_request_limit=get_wallet_nfts_request_limit,
+        get_collection_sales_request_limit=get_collection_sales_request_limit,
+    )
+
+    # the DataFrames are built once the failed work has been retried
+    data = dict()
+    for slug, slug_tables in tables.items():
+        data[slug] = {
+            name: pd.DataFrame(table.columns, columns=list(table.columns))
+            for name, table in slug_tables.items()
+        }
+        if output_dir != None:
+            write_data_to_dir(data[slug], os.path.join(output_dir, slug))
+
+    return data, failed
+
+class DependentWork:
+    """ Gets the listings of the nfts of a slug, and
+    the nfts and transactions of their owners and of
+    the sellers, for the rows added to those tables
+    since the last call, so the rows recovered by the
+    ledger get them too. """
+
+    def __init__(
+        self,
+        slug,
+        api_client,
+        ledger,
+        tables,
+        get_listings_request_limit=1,
+        get_wallet_transactions_request_limit=1,
+        get_wallet_nfts_request_limit=1,
+    ):
+        self.slug = slug
+        self.api_client = api_client
+        self.ledger = ledger
+        self.tables = tables
+        self.get_listings_request_limit = get_listings_request_limit
+        self.get_wallet_transactions_request_limit = get_wallet_transactions_request_limit
+        self.get_wallet_nfts_request_limit = get_wallet_nfts_request_limit
+        # nfts whose listings were requested, and wallets
+        # whose nfts and transactions were requested
+        self.n_listed = 0
+        self.nfts_wallets = set()
+        self.transactions_wallets = set()
+
+    def __call__(self):
+        self.get_listings()
+        self.get_wallets()
+
+    def get_listings(self):
+        nfts = self.tables["nfts"]
+        n_nfts = len(nfts.column("token_id"))
+        if self.get_listings_request_limit != None:
+            n_nfts = min(n_nfts, self.get_listings_request_limit)
+        with ThreadPoolExecutor(max_workers=self.api_client.RATE) as executor:
+            for i in range(self.n_listed, n_nfts):
+                # offset the threads
+                time.sleep(THREAD_OFFSET)
+                executor.submit(
+                    run_work,
+                    self.ledger,
+                    save_asset_listings,
+                    contr_addr=nfts.column("contract_address")[i],
+                    token_id=nfts.column("token_id")[i],
+                    asset_url=nfts.column("asset_url")[i],
+                    image_url=nfts.column("image_url")[i],
+                    api_client=self.api_client,
+                    table=self.tables["listings"],
+                )
+        self.n_listed = max(self.n_listed, n_nfts)
+
+    def get_wallets(self):
+        # get a list of owners for this collection
+        # and add the sellers, removing duplicates
+        col_owners = set(self.tables["nfts"].column("owner"))
+        owners_and_sellers = col_owners.copy()
+        owners_and_sellers.update(
+            seller for seller in self.tables["sales"].column("seller") if seller
+        )
+        owners_and_sellers -= self.nfts_wallets
+        col_owners -= self.transactions_wallets
+        self.nfts_wallets.update(owners_and_sellers)
+        self.transactions_wallets.update(col_owners)
+
+        if owners_and_sellers:
+            print_progress(self.slug, self.api_client, f"Getting nfts for {len(owners_and_sellers)} owners and sellers")
+        # for these sellers and owners, get a list of their nfts
+        with ThreadPoolExecutor(max_workers=self.api_client.RATE) as executor:
+            for wallet in owners_and_sellers:
+                # offset the threads
+                time.sleep(THREAD_OFFSET)
+                executor.submit(
+                    run_work,
+                    self.ledger,
+                    save_wallet_assets,
+                    wallet=wallet,
+                    api_client=self.api_client,
+                    table=self.tables["owner_and_seller_nfts"],
+                    limit_requests=self.get_wallet_nfts_request_limit,
+                )
+
+        if col_owners:
+            print_progress(self.slug, self.api_client, f"Getting transactions for {len(col_owners)} owners")
+        # get the transaction histories for the collection owners
+        with ThreadPoolExecutor(max_workers=self.api_client.RATE) as executor:
+            for wallet in col_owners:
+                # offset the threads
+                time.sleep(THREAD_OFFSET)
+                executor.submit(
+                    run_work,
+                    self.ledger,
+                    save_wallet_transactions,
+                    wallet=wallet,
+                    api_client=self.api_client,
+                    table=self.tables["owner_transactions"],
+                    limit_requests=self.get_wallet_transactions_request_limit,
+                )
+
+def get_slug_data(
+    slug,
+    api_client,
+    ledger,
+    tables,
+    get_collection_nfts_request_limit=1,
+    get_listings_request_limit=1,
+    get_wallet_transactions_request_limit=1,
+    get_wallet_nfts_request_limit=1,
+    get_collection_sales_request_limit=1,
+):
+    # get info for this collection, which is also
+    # used to split the sales history in windows
+    col_json = run_work(
+        ledger,
+        save_col_info,
+        slug=slug,
+        api_client=api_client,
+        table=tables["info"],
+    )
+
+    # get the list of nfts for this collection
+    nfts = tables["nfts"]
+    run_work(
+        ledger,
+        save_col_assets_data,
+        slug=slug,
+        api_client=api_client,
+        table=nfts,
+        limit_requests=get_collection_nfts_request_limit,
+    )
+
+    n_nfts = len(nfts.column("token_id"))
+    print_progress(slug, api_client, f"Got {n_nfts} nfts")
+    # the listings and wallets are fetched for the nfts
+    # and sales saved by now, and by the ledger later
+    dependent = DependentWork(
+        slug,
+        api_client,
+        ledger,
+        tables,
+        get_listings_request_limit=get_listings_request_limit,
+        get_wallet_transactions_request_limit=get_wallet_transactions_request_limit,
+        get_wallet_nfts_request_limit=get_wallet_nfts_request_limit,
+    )
+    ledger.follow_up(dependent)
+    # get the listings for the collection nfts
+    dependent.get_listings()
+
+    print_progress(slug, api_client, "Got listings")
+    # get the collection sales, splitting the whole
+    # history in windows sized from the collection info
+    windows = None
+    if get_collection_sales_request_limit == None and col_json != None:
+        windows = [
+            (after, before, None) for after, before in
+            api_client.get_sales_windows(col_json)
+        ]
+    run_work(
+        ledger,
+        save_collection_sales,
+        slug=slug,
+        api_client=api_client,
+        table=tables["sales"],
+        limit_requests=get_collection_sales_request_limit,
+        windows=windows,
+    )
+
+    # get the nfts of the owners and sellers,
+    # and the transactions of the owners
+    dependent.get_wallets()
+
+    return tables
+
+def write_data_to_dir(slug_data, slug_dir):
+    os.makedirs(slug_dir, exist_ok=True)
+    for name, file_name, _ in TABLES:
+        slug_data[name].to_csv(
+            os.path.join(slug_dir, file_name), index=False
         )
-    except Exception as e:
-        print(e)
 
 def get_and_write_data(
     api_key,
@@ -73,6 +554,8 @@ def get_and_write_data(
     get_wallet_nfts_request_limit=1,
     get_collection_sales_request_limit=1,
     output_dir='./results',
+    max_concurrent_slugs=MAX_CONCURRENT_SLUGS,
+    trace_path=None,
 ):
     """ This function performs all the requested data
     extraction, and writes the results to csv files
@@ -107,128 +590,35 @@ def get_and_write_data(
     - get_collection_sales_request_limit: limits the
     ammount of requests performed when getting a list
     of sales regarding a collection. 300 sales are
-    returned for each request. """
-
-    api_client = ApiClient(api_key=api_key)
-
-    for slug in slugs:
-        os.makedirs(os.path.join(output_dir, slug), exist_ok=True)
-        info_path = os.path.join(output_dir, slug, 'info.csv')
-        nft_data_path = os.path.join(output_dir, slug, 'nft_data.csv')
-        listings_path = os.path.join(output_dir, slug, 'listings.csv')
-        collection_sales_path = os.path.join(output_dir, slug, 'collection_sales.csv')
-        owner_transactions_path = os.path.join(output_dir, slug, 'owner_transactions.csv')
-        owner_and_seller_nfts_path = os.path.join(output_dir, slug, 'owner_and_seller_nfts.csv')
-
-        # write csv headers
-        for path, fields in [
-            (info_path, api_client.col_fields),
-            (nft_data_path, api_client.data_fields),
-            (listings_path, api_client.listing_fields),
-            (collection_sales_path, api_client.transaction_fields),
-            (owner_transactions_path, api_client.transaction_fields),
-            (owner_and_seller_nfts_path, api_client.nft_fields),
-        ]:
-            with open(path, 'a') as f:
-                thing_writer = csv.DictWriter(f, fieldnames=fields)
-                thing_writer.writeheader()
-
-        # get info for this collection
-        col_info = api_client.get_collection_info(slug)
-        # write info to csv file
-        with open(info_path, 'a') as f:
-            info_writer = csv.DictWriter(f, fieldnames=api_client.col_fields)
-            info_writer.writerow(col_info)
-
-        # save a list of nft data for this collection
-        with open(nft_data_path, 'a') as f:
-            data_writer = csv.DictWriter(f, fieldnames=api_client.data_fields)
-            for data_list in api_client.get_col_assets_data(
-                slug, limit_requests=get_collection_nfts_request_limit
-            ):
-                data_writer.writerows(data_list)
-
-        # get the list of nfts for this collection
-        assets = list()
-        with open(nft_data_path, 'r') as f:
-            data_reader = csv.DictReader(f)
-            for line in data_reader:
-                assets.append(
-                    {
-                        "asset_url": line["asset_url"],
-                        "image_url": line["image_url"],
-                        "contract_address": line["contract_address"],
-                        "token_id": line["token_id"],
-                    }
-                )
+    returned for each request.
 
-        # get the listings for the
-        # collection nfts and save them to a csv file
-        with ThreadPoolExecutor(max_workers=api_client.RATE) as executor:
-            for i, asset in enumerate(assets):
-                if i+1 > get_listings_request_limit:
-                    break
-                # offset the threads
-                time.sleep(THREAD_OFFSET)
-                executor.submit(
-                    save_asset_listings,
-                    contr_addr=asset["contract_address"],
-                    token_id=asset["token_id"],
-                    asset_url=asset["asset_url"],
-                    image_url=asset["image_url"],
-                    api_client=api_client,
-                    file_path=listings_path,
-                )
+    - max_concurrent_slugs: the ammount of collections
+    that are processed at the same time. All of them
+    share the API rate limit, which is split evenly
+    between the collections that have requests waiting.
 
-        # get and write the collection sales to a csv file
-        for sales_list in api_client.get_collection_sales(
-            slug, limit_requests=get_collection_sales_request_limit
-        ):
-            write_things_to_file(
-                things=sales_list,
-                path=collection_sales_path,
-                fieldnames=api_client.transaction_fields,
-            )
+    - trace_path: if given, the time spent waiting for
+    the rate limit, sleeping after errors, on the network,
+    decoding, parsing and writing is traced, written to
+    this path as a Chrome trace (open it in
+    ui.perfetto.dev), and summarized when the run ends.
 
-        # get a list of owners for this collection
-        # remove duplicate owners, if any
-        col_owners = set()
-        with open(nft_data_path, 'r') as f:
-            data_reader = csv.DictReader(f)
-            for line in data_reader:
-                col_owners.add(line["owner"])
-
-        # add the sellers from sales file
-        owners_and_sellers = col_owners.copy()
-        with open(collection_sales_path, 'r') as f:
-            sales_reader = csv.DictReader(f)
-            for line in sales_reader:
-                owners_and_sellers.add(line["seller"])
-
-        # for these sellers and owners, get a list
-        # of their nfts and save them to a csv file
-        with ThreadPoolExecutor(max_workers=api_client.RATE) as executor:
-            for wallet in owners_and_sellers:
-                # offset the threads
-                time.sleep(THREAD_OFFSET)
-                executor.submit(
-                    save_wallet_assets,
-                    wallet=wallet,
-                    api_client=api_client,
-                    limit_requests=get_wallet_nfts_request_limit,
-                    file_path=owner_and_seller_nfts_path,
-                )
+    Returns a dict with the exception raised for every
+    slug that could not be processed. Slugs whose data
+    is missing requests that the API rejected, or that
+    kept failing after being retried at the end of the
+    run, get an IncompleteDataError, listing that work. """
 
-        # get the transaction histories for the
-        # collection owners and save them to a csv file
-        with ThreadPoolExecutor(max_workers=api_client.RATE) as executor:
-            for wallet in col_owners:
-                # offset the threads
-                time.sleep(THREAD_OFFSET)
-                executor.submit(
-                    save_wallet_transactions,
-                    wallet=wallet,
-                    api_client=api_client,
-                    limit_requests=get_wallet_transactions_request_limit,
-                    file_path=owner_transactions_path,
-                )
+    _, failed = run_slugs(
+        partial(new_csv_tables, output_dir=output_dir),
+        api_key=api_key,
+        slugs=slugs,
+        max_concurrent_slugs=max_concurrent_slugs,
+        trace_path=trace_path,
+        get_collection_nfts_request_limit=get_collection_nfts_request_limit,
+        get_listings_request_limit=get_listings_request_limit,
+        get_wallet_transactions_request_limit=get_wallet_transactions_request_limit,
+        get_wallet_nfts_request_limit=get_wallet_nfts_request_limit,
+        get_collection_sales_request_limit=get_collection_sales_request_limit,
+    )
+    return failed
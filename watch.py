@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import heapq
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from client import ApiClient, OSAPIError, event_time
+from ratelimit import FairShareLimiter
+from retry import RetryPolicy
+
+# sales and new listings
+EVENT_TYPES = ["successful", "created"]
+MIN_INTERVAL = 2
+MAX_INTERVAL = 120
+# events can show up in the API some time after they
+# happened, so every poll looks this far behind the
+# newest event already seen
+LAG = 60
+
+class JsonlSink:
+    """ Writes every event as a line of JSON, appending
+    to the file at path, or to stdout if path is None. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, slug, event_type, events):
+        lines = [
+            json.dumps(dict(event, slug=slug, event_type=event_type))
+            for event in events
+        ]
+        if not lines:
+            return
+        with self.lock:
+            if self.path == None:
+                print("\n".join(lines), flush=True)
+            else:
+                with open(self.path, 'a') as f:
+                    f.write("\n".join(lines) + "\n")
+
+class SqliteSink:
+    """ Inserts every event into the events table of the
+    SQLite database at path, skipping the ones already
+    there. """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id TEXT PRIMARY KEY, slug TEXT, event_type TEXT, "
+                "timestamp TEXT, data TEXT)"
+            )
+
+    def emit(self, slug, event_type, events):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        str(event["id"]),
+                        slug,
+                        event_type,
+                        event["timestamp"],
+                        json.dumps(event),
+                    ) for event in events
+                ],
+            )
+
+class SlugWatch:
+    """ Polling state for a single collection: the
+    high-water mark and recently seen events for each
+    event type, and the current polling interval. """
+
+    def __init__(
+        self,
+        slug,
+        api_client,
+        event_types=EVENT_TYPES,
+        min_interval=MIN_INTERVAL,
+        max_interval=MAX_INTERVAL,
+        state=None,
+    ):
+        self.slug = slug
+        self.api_client = api_client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.parsers = {
+            "successful": api_client.parse_transaction,
+            "created": api_client.parse_listing_event,
+        }
+        state = state or dict()
+        self.marks = dict()
+        for event_type in event_types:
+            mark = state.get(event_type, dict())
+            self.marks[event_type] = {
+                "after": mark.get("after", time.time()),
+                "seen": set(mark.get("seen", list())),
+            }
+
+    def state(self):
+        return {
+            event_type: {
+                "after": mark["after"],
+                "seen": sorted(mark["seen"]),
+            } for event_type, mark in self.marks.items()
+        }
+
+    def poll(self, sink):
+        n_events = 0
+        failed = False
+        for event_type, mark in self.marks.items():
+            events = list()
+            try:
+                for events_list in self.api_client.get_collection_events(
+                    self.slug,
+                    event_type,
+                    occurred_after=int(mark["after"] - LAG),
+                ):
+                    events.extend(events_list)
+            except OSAPIError as e:
+                # nothing is emitted, the next poll
+                # starts from the same mark
+                self.api_client.log(e)
+                failed = True
+                continue
+
+            # emit the new events oldest first
+            new_events = [
+                event for event in reversed(events)
+                if event["id"] not in mark["seen"]
+            ]
+            parse = self.parsers[event_type]
+            sink.emit(self.slug, event_type, [
+                dict(parse(event), id=event["id"])
+                for event in new_events
+            ])
+            n_events += len(new_events)
+
+            after = mark["after"]
+            if events:
+                after = max(after, max(event_time(e) for e in events))
+            # replaced at once, so the state saved by
+            # another thread never mixes two polls, and
+            # only the events within LAG of the mark
+            # can be returned by the next poll
+            self.marks[event_type] = {
+                "after": after,
+                "seen": {
+                    event["id"] for event in events
+                    if event_time(event) >= after - LAG
+                },
+            }
+
+        # poll busy collections more often
+        # and quiet ones less and less, but a
+        # failed poll says nothing about activity
+        if n_events:
+            self.interval = max(self.min_interval, self.interval/2)
+        elif not failed:
+            self.interval = min(self.max_interval, self.interval*1.5)
+        return n_events
+
+def load_state(state_path):
+    if state_path == None or not os.path.exists(state_path):
+        return dict()
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+def save_state(state_path, state):
+    # write to a temporary file first, so a crash
+    # never leaves a half written state behind
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def watch(
+    api_key,
+    slugs,
+    sink=None,
+    event_types=EVENT_TYPES,
+    min_interval=MIN_INTERVAL,
+    max_interval=MAX_INTERVAL,
+    state_path=None,
+    stop=None,
+):
+    """ This function keeps polling the events of the
+    given collections, and emits every new sale and
+    listing to the sink as soon as it is seen, until
+    stop is set (or forever, if stop is None).
+
+    - sink: where new events are sent. JsonlSink writes
+    them as JSON lines to stdout or to a file, and
+    SqliteSink inserts them into a SQLite database. Any
+    object with an emit(slug, event_type, events) method
+    can be used. Defaults to JSON lines on stdout.
+    Errors and retries are printed to stderr.
+
+    - event_types: the event types to watch, "successful"
+    for sales and "created" for new listings.
+
+    - min_interval, max_interval: bounds, in seconds, for
+    the time between polls of a collection. Collections
+    with new events are polled more often, and quiet ones
+    less often. All of them share the API rate limit,
+    which is split evenly between the collections that
+    are due.
+
+    - state_path: if given, the high-water mark of every
+    collection is saved to this file after each poll and
+    loaded on start, so a restarted watch continues where
+    the previous one stopped. Otherwise it starts with
+    the events of the last LAG seconds. """
+
+    if sink == None:
+        sink = JsonlSink()
+    if stop == None:
+        stop = threading.Event()
+    limiter = FairShareLimiter(calls=ApiClient.RATE, period=1)
+    retry_policy = RetryPolicy()
+    state = load_state(state_path)
+    watches = [
+        SlugWatch(
+            slug,
+            ApiClient(
+                api_key=api_key,
+                limiter=limiter,
+                key=slug,
+                retry_policy=retry_policy,
+                verbose=False,
+                # keep stdout for the events
+                log_file=sys.stderr,
+            ),
+            event_types=event_types,
+            min_interval=min_interval,
+            max_interval=max_interval,
+            state=state.get(slug),
+        ) for slug in slugs
+    ]
+
+    # (next poll time, index) of every watch not being polled
+    due = [(time.monotonic(), i) for i in range(len(watches))]
+    cond = threading.Condition()
+    # one poll saves the state at a time, so an older
+    # state is never written over a newer one
+    save_lock = threading.Lock()
+
+    def poll(i):
+        w = watches[i]
+        try:
+            w.poll(sink)
+            if state_path != None:
+                with save_lock:
+                    # the file is written without holding
+                    # cond, so the polls are still dispatched
+                    with cond:
+                        state = {
+                            other.slug: other.state() for other in watches
+                        }
+                    save_state(state_path, state)
+        except Exception as e:
+            w.api_client.log(f"[{w.slug}] {e}")
+        with cond:
+            heapq.heappush(due, (time.monotonic() + w.interval, i))
+            cond.notify()
+
+    with ThreadPoolExecutor(max_workers=2*ApiClient.RATE) as executor:
+        while not stop.is_set():
+            with cond:
+                now = time.monotonic()
+                if due and due[0][0] <= now:
+                    _, i = heapq.heappop(due)
+                    executor.submit(poll, i)
+                    continue
+                # wake up at least every second to check stop
+                wait = 1
+                if due:
+                    wait = min(wait, due[0][0] - now)
+                cond.wait(wait)
+
+if __name__ == '__main__':
+
+    slugs = [
+        "rtfkt-capsule-space-drip-1-2",
+    ]
+
+    watch(
+        api_key="",
+        slugs=slugs,
+        sink=JsonlSink(),
+        state_path='./watch-state.json',
+    )